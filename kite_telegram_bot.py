@@ -1,19 +1,33 @@
 # kite_telegram_bot.py
+# Annotations stay unevaluated strings, so handler signatures can reference
+# lazily imported telegram types.
+from __future__ import annotations
+
+import asyncio
+import functools
+import operator
 import os
-import json
+import time
 from datetime import datetime, timedelta
-from threading import Thread
 
-from flask import Flask, request
+import numpy as np
+import orjson
+from aiohttp import web
 from kiteconnect import KiteConnect
-from telegram import Update
-from telegram.ext import Application, CommandHandler, ContextTypes
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# python-telegram-bot is heavyweight (pulls in httpx etc.); it is imported
+# lazily in main() / the webhook route to cut cold-start time on Render.
 
 # ---------------- CONFIG -----------------
 API_KEY = os.getenv("KITE_API_KEY")
 API_SECRET = os.getenv("KITE_API_SECRET")
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 REDIRECT_URL = os.getenv("REDIRECT_URL", "http://127.0.0.1:5000/callback")
+# Public base URL of this service (e.g. the Render URL). When set, Telegram
+# updates arrive over a webhook instead of getUpdates long-polling.
+PUBLIC_URL = os.getenv("PUBLIC_URL", "").rstrip("/")
 TOKENS_FILE = "tokens.json"
 PORT = int(os.getenv("PORT", 5000))
 
@@ -22,79 +36,123 @@ if not (API_KEY and API_SECRET and TELEGRAM_TOKEN):
 
 kite = None
 
+# Validation results cached per access token so /snapshot doesn't hit
+# kite.profile() (a full HTTPS round-trip) on every command.
+_token_valid_cache = {}  # access_token -> expiry epoch
+_TOKEN_VALID_TTL = 300  # seconds
+
+def _token_cache_expiry() -> float:
+    # Kite flushes access tokens daily around 6 AM IST; never cache past that.
+    now = datetime.now()
+    flush = now.replace(hour=6, minute=0, second=0, microsecond=0)
+    if now >= flush:
+        flush += timedelta(days=1)
+    return min(time.time() + _TOKEN_VALID_TTL, flush.timestamp())
+
 # ---------------- Token Helpers -----------------
+# Parsed tokens.json cached in memory; re-read only when the file mtime changes.
+_tokens_cache = {"mtime": 0, "data": None}
+
 def save_tokens(tokens: dict):
-    data = tokens.copy()
-    if "expires_at" in data and isinstance(data["expires_at"], datetime):
-        data["expires_at"] = data["expires_at"].isoformat()
-    data["saved_at"] = datetime.now().isoformat()
-    with open(TOKENS_FILE, "w") as f:
-        json.dump(data, f)
+    # Timestamps are stored as epoch floats: cheap to compare on load, no
+    # datetime construction or ISO parsing needed.
+    data = {**tokens, "saved_at": time.time()}
+    if isinstance(data.get("expires_at"), datetime):
+        data["expires_at"] = data["expires_at"].timestamp()
+    # Write to a tmp file and rename: os.replace is atomic on POSIX, so a
+    # concurrent load_tokens() sees either the old or new file, never a torn one.
+    tmp = TOKENS_FILE + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(orjson.dumps(data))
+    os.replace(tmp, TOKENS_FILE)
 
 def load_tokens():
     if not os.path.exists(TOKENS_FILE):
         return None
-    with open(TOKENS_FILE, "r") as f:
-        data = json.load(f)
-    if "saved_at" in data:
-        try:
-            data["saved_at"] = datetime.fromisoformat(data["saved_at"])
-        except Exception:
-            data["saved_at"] = datetime.now() - timedelta(days=1)
+    st = os.stat(TOKENS_FILE)
+    if st.st_mtime == _tokens_cache["mtime"]:
+        return _tokens_cache["data"]
+    with open(TOKENS_FILE, "rb") as f:
+        data = orjson.loads(f.read())
+    _tokens_cache["mtime"] = st.st_mtime
+    _tokens_cache["data"] = data
     return data
 
 # ---------------- Kite Client -----------------
+# One shared client for the whole process. KiteConnect.__init__ builds a
+# fresh requests.Session (new TCP/TLS pool) every time, so reusing a single
+# instance keeps the HTTPS connection to api.kite.trade warm across calls.
+# The bot is single-user, so swapping the access token on it is safe.
+_KITE_BASE = KiteConnect(api_key=API_KEY)
+# Everything goes to the single api.kite.trade host, so size the pool
+# explicitly and retry transient failures instead of surfacing the tail
+# latency of an idle connection being dropped.
+_KITE_BASE.reqsession.mount(
+    "https://",
+    HTTPAdapter(pool_connections=1, pool_maxsize=4,
+                max_retries=Retry(total=2, backoff_factor=0.3)),
+)
+
 def kite_client_with_token(access_token: str):
-    k = KiteConnect(api_key=API_KEY)
-    k.set_access_token(access_token)
-    return k
+    _KITE_BASE.set_access_token(access_token)
+    return _KITE_BASE
 
 def is_access_token_valid(access_token: str) -> bool:
+    if _token_valid_cache.get(access_token, 0) > time.time():
+        return True
     try:
         k = kite_client_with_token(access_token)
         k.profile()
+        _token_valid_cache[access_token] = _token_cache_expiry()
         return True
     except Exception:
         return False
 
 def ensure_tokens_valid() -> bool:
+    # Reuse the shared client and only swap its access token; rebuilding it
+    # would discard the warm pooled connection to api.kite.trade.
     global kite
+    if kite is None:
+        kite = _KITE_BASE
+    if _token_valid_cache.get(kite.access_token, 0) > time.time():
+        return True
     saved = load_tokens()
     if not saved:
         return False
     access_token = saved.get("access_token")
     if access_token and is_access_token_valid(access_token):
-        kite = kite_client_with_token(access_token)
+        kite.set_access_token(access_token)
         return True
     refresh_token = saved.get("refresh_token")
     if not refresh_token:
         return False
     try:
-        kite_base = KiteConnect(api_key=API_KEY)
-        newdata = kite_base.renew_access_token(refresh_token, api_secret=API_SECRET)
+        newdata = _KITE_BASE.renew_access_token(refresh_token, api_secret=API_SECRET)
         merged = {**saved, **newdata}
         save_tokens(merged)
-        kite = kite_client_with_token(merged["access_token"])
+        _token_valid_cache.pop(access_token, None)
+        _token_valid_cache[merged["access_token"]] = _token_cache_expiry()
+        kite.set_access_token(merged["access_token"])
         return True
     except Exception as e:
         print("Token refresh failed:", e)
         return False
 
-# ---------------- Flask Callback -----------------
-app = Flask(__name__)
-
-@app.route("/callback")
-def callback():
-    req_token = request.args.get("request_token")
+# ---------------- Kite OAuth Callback -----------------
+# Served with aiohttp on the same asyncio loop as the Telegram bot, so no
+# background thread (and no Werkzeug dev server) is needed.
+async def callback(request: web.Request) -> web.Response:
+    req_token = request.query.get("request_token")
     if not req_token:
-        return "❌ No request_token received. Login failed.", 400
+        return web.Response(text="❌ No request_token received. Login failed.", status=400)
     try:
-        kite_base = KiteConnect(api_key=API_KEY)
-        session = kite_base.generate_session(req_token, api_secret=API_SECRET)
+        session = await asyncio.get_running_loop().run_in_executor(
+            None, lambda: _KITE_BASE.generate_session(req_token, api_secret=API_SECRET)
+        )
         save_tokens(session)
-        return "✅ Login success! You can return to Telegram and use /snapshot."
+        return web.Response(text="✅ Login success! You can return to Telegram and use /snapshot.")
     except Exception as e:
-        return f"❌ Error creating session: {e}", 500
+        return web.Response(text=f"❌ Error creating session: {e}", status=500)
 
 # ---------------- Telegram Commands -----------------
 async def start_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -102,41 +160,116 @@ async def start_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "👋 Hello! Use /login to authenticate Kite, then /snapshot to view portfolio."
     )
 
+@functools.lru_cache(maxsize=1)
+def _login_url() -> str:
+    # Deterministic for fixed API_KEY/REDIRECT_URL, so build it once.
+    return _KITE_BASE.login_url() + f"&redirect_uri={REDIRECT_URL}"
+
 async def login_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    kite_base = KiteConnect(api_key=API_KEY)
-    login_url = kite_base.login_url()
-    login_url += f"&redirect_uri={REDIRECT_URL}"
-    await update.message.reply_text(f"🔐 Click to login to Kite:\n{login_url}")
+    await update.message.reply_text("🔐 Click to login to Kite:\n" + _login_url())
+
+# Row template bound once so format-spec parsing stays out of the hot loop.
+_ROW_FMT = "{:<10} {:>5} {:>10.2f} {:>10.2f} {} {:>9.2f}\n".format
+# Invariant chrome built (and pre-encoded) once at import; only rows and the
+# total line are dynamic.
+_HEADER_BYTES = (
+    "📌 Portfolio Snapshot\n\n<pre>"
+    + f"{'Symbol':<10} {'Qty':>5} {'Avg':>10} {'LTP':>10} {'P&L':>12}\n"
+    + "-"*52 + "\n"
+).encode("utf-8")
+_SEP_BYTES = ("-"*52 + "\n").encode("utf-8")
+_CLOSE_BYTES = b"</pre>"
+# One C-level call extracting all four fields per holding, instead of four
+# separate dict.get() calls.
+_GET = operator.itemgetter("tradingsymbol", "quantity", "average_price", "last_price")
+# Indexed by (pnl >= 0): branchless pick instead of a per-row conditional.
+_EMOJI = ("🔴", "🟢")
 
 def format_portfolio_table(holdings):
-    header = "📌 Portfolio Snapshot\n\n"
-    rows = []
-    rows.append(f"{'Symbol':<10} {'Qty':>5} {'Avg':>10} {'LTP':>10} {'P&L':>12}")
-    rows.append("-"*52)
-    total_pnl = 0.0
-    for h in holdings:
-        sym = h.get("tradingsymbol", "N/A")
-        qty = h.get("quantity", 0)
-        avg = h.get("average_price", 0.0) or 0.0
-        ltp = h.get("last_price", 0.0) or 0.0
-        try:
-            pnl = (ltp - avg) * qty
-        except Exception:
-            pnl = 0.0
-        total_pnl += pnl
-        emoji = "🟢" if pnl >= 0 else "🔴"
-        rows.append(f"{sym:<10} {qty:>5} {avg:>10.2f} {ltp:>10.2f} {emoji} {pnl:>9.2f}")
-    rows.append("-"*52)
-    tot_emoji = "🟢" if total_pnl >= 0 else "🔴"
-    rows.append(f"{'TOTAL':<10} {'':>5} {'':>10} {'':>10} {tot_emoji} {total_pnl:>9.2f}")
-    return header + "<pre>" + "\n".join(rows) + "</pre>"
+    # Rows are appended straight into one resizable bytearray (amortized O(1)
+    # growth), skipping the intermediate list-of-strings + join allocation.
+    n = len(holdings)
+    buf = bytearray(_HEADER_BYTES)
+    # P&L arithmetic vectorized in NumPy; the loop below only does formatting.
+    try:
+        cols = list(map(_GET, holdings))
+    except KeyError:
+        # Slow path preserving .get() defaults for rows missing a field.
+        cols = [
+            (h.get("tradingsymbol", "N/A"), h.get("quantity", 0),
+             h.get("average_price", 0.0) or 0.0, h.get("last_price", 0.0) or 0.0)
+            for h in holdings
+        ]
+    qty = np.fromiter((c[1] or 0 for c in cols), dtype=np.float64, count=n)
+    avg = np.fromiter((c[2] or 0.0 for c in cols), dtype=np.float64, count=n)
+    ltp = np.fromiter((c[3] or 0.0 for c in cols), dtype=np.float64, count=n)
+    pnl = (ltp - avg) * qty
+    total_pnl = float(pnl.sum())
+    for i, c in enumerate(cols):
+        buf += _ROW_FMT(c[0], c[1], avg[i], ltp[i], _EMOJI[pnl[i] >= 0.0], pnl[i]).encode("utf-8")
+    tot_emoji = _EMOJI[total_pnl >= 0.0]
+    total_line = f"{'TOTAL':<10} {'':>5} {'':>10} {'':>10} {tot_emoji} {total_pnl:>9.2f}"
+    buf += _SEP_BYTES + total_line.encode("utf-8") + _CLOSE_BYTES
+    return buf.decode("utf-8")
+
+# Holdings cached briefly and fetched single-flight, so a burst of /snapshot
+# taps produces at most one upstream Kite call.
+_HOLDINGS_TTL = 15  # seconds
+_holdings_cache = {"at": 0.0, "data": None}
+_holdings_lock = asyncio.Lock()
+
+# Quantity and average price only change on trades; cache them for 5 minutes
+# and refresh just the last prices via the far lighter ltp() endpoint in
+# between, instead of re-fetching (and re-parsing) full holdings every time.
+_STATIC_TTL = 300  # seconds
+_holdings_static = {"at": 0.0, "data": None}
+
+def _fetch_holdings():
+    """Blocking fetch: full holdings when the static cache is stale, otherwise
+    an ltp()-only price refresh merged onto the cached static fields."""
+    if time.monotonic() - _holdings_static["at"] >= _STATIC_TTL or not _holdings_static["data"]:
+        holdings = kite.holdings() or []
+        _holdings_static["data"] = [
+            {
+                "tradingsymbol": h.get("tradingsymbol", "N/A"),
+                "exchange": h.get("exchange", "NSE"),
+                "quantity": h.get("quantity", 0),
+                "average_price": h.get("average_price", 0.0) or 0.0,
+                "last_price": h.get("last_price", 0.0) or 0.0,
+            }
+            for h in holdings
+        ]
+        _holdings_static["at"] = time.monotonic()
+        return _holdings_static["data"]
+    instruments = [f"{h['exchange']}:{h['tradingsymbol']}" for h in _holdings_static["data"]]
+    quotes = kite.ltp(instruments)
+    for h, inst in zip(_holdings_static["data"], instruments):
+        q = quotes.get(inst)
+        if q:
+            h["last_price"] = q.get("last_price", h["last_price"])
+    return _holdings_static["data"]
+
+async def _get_holdings(loop):
+    if time.monotonic() - _holdings_cache["at"] < _HOLDINGS_TTL:
+        return _holdings_cache["data"]
+    async with _holdings_lock:
+        # Re-check: another waiter may have refreshed while we queued.
+        if time.monotonic() - _holdings_cache["at"] < _HOLDINGS_TTL:
+            return _holdings_cache["data"]
+        holdings = await loop.run_in_executor(None, _fetch_holdings)
+        _holdings_cache["data"] = holdings
+        _holdings_cache["at"] = time.monotonic()
+        return holdings
 
 async def snapshot_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not ensure_tokens_valid():
+    # kiteconnect is requests-based (blocking); run its calls in a thread
+    # executor so they don't stall the event loop for other handlers.
+    loop = asyncio.get_running_loop()
+    if not await loop.run_in_executor(None, ensure_tokens_valid):
         await update.message.reply_text("⚠️ Session missing/expired. Please use /login and complete the flow.")
         return
     try:
-        holdings = kite.holdings() or []
+        holdings = await _get_holdings(loop)
         if not holdings:
             await update.message.reply_text("📭 No holdings found.")
             return
@@ -145,24 +278,54 @@ async def snapshot_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     except Exception as e:
         await update.message.reply_text(f"❌ Error fetching portfolio: {e}")
 
-# ---------------- Run Flask + Telegram -----------------
-def run_flask():
-    app.run(host="0.0.0.0", port=PORT)
+# ---------------- Run Callback Server + Telegram -----------------
+async def _start_callback_server(application):
+    webapp = web.Application()
+    webapp.router.add_get("/callback", callback)
+    if PUBLIC_URL:
+        from telegram import Update
+
+        # Telegram webhook served from the same aiohttp app (one port, one
+        # event loop); updates are handed straight to the Application queue.
+        async def telegram_webhook(request: web.Request) -> web.Response:
+            update = Update.de_json(await request.json(), application.bot)
+            application.update_queue.put_nowait(update)
+            return web.Response(text="OK")
+        webapp.router.add_post(f"/{TELEGRAM_TOKEN}", telegram_webhook)
+    runner = web.AppRunner(webapp)
+    await runner.setup()
+    await web.TCPSite(runner, "0.0.0.0", PORT).start()
+    if PUBLIC_URL:
+        await application.bot.set_webhook(f"{PUBLIC_URL}/{TELEGRAM_TOKEN}")
+
+async def _run_webhook(application):
+    async with application:
+        await _start_callback_server(application)
+        await application.start()
+        await asyncio.Event().wait()
 
 def main():
-    Thread(target=run_flask, daemon=True).start()
+    from telegram.ext import Application, CommandHandler
+
     if load_tokens():
         print("Attempting to validate or refresh saved tokens at startup...")
         if ensure_tokens_valid():
             print("Tokens valid/refreshed at startup.")
         else:
             print("Saved tokens invalid/refresh failed. Use /login.")
-    application = Application.builder().token(TELEGRAM_TOKEN).build()
+    builder = Application.builder().token(TELEGRAM_TOKEN)
+    if not PUBLIC_URL:
+        builder = builder.post_init(_start_callback_server)
+    application = builder.build()
     application.add_handler(CommandHandler("start", start_cmd))
     application.add_handler(CommandHandler("login", login_cmd))
     application.add_handler(CommandHandler("snapshot", snapshot_cmd))
-    print("Bot started. Waiting for Telegram commands.")
-    application.run_polling()
+    if PUBLIC_URL:
+        print("Bot started (webhook mode). Waiting for Telegram commands.")
+        asyncio.run(_run_webhook(application))
+    else:
+        print("Bot started (polling mode). Waiting for Telegram commands.")
+        application.run_polling()
 
 if __name__ == "__main__":
     main()